@@ -2,36 +2,585 @@
 """
 Simple AI Chatbot HTTP Server
 Run this file to start the chatbot on http://localhost:8000
+Run with --headless (or CHATBOT_HEADLESS=1) for production; see --help for all options
 """
 
 import http.server
 import socketserver
 import json
 import urllib.parse
-import requests
 from datetime import datetime
 import os
-import webbrowser
+import argparse
+import errno
+import functools
+import importlib
+import signal
 import threading
 import time
 import sys
 import base64
+import email.utils
+import gzip
+import hashlib
+import hmac
+import ipaddress
 import mimetypes
+import re
+import select
+import socket
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, as_completed, wait
 from pathlib import Path
 
-# Gemini API configuration
-GEMINI_API_KEY = "Enter your api key"
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class LazyModule:
+    """Import a module on first attribute access to keep server start-up fast"""
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def load(self):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+    def is_loaded(self):
+        return self.module is not None
+
+# requests takes longer to import than the rest of the server, so load it after the port is open
+requests = LazyModule('requests')
+
+# Gemini API configuration (the key can also be passed with --api-key)
+API_KEY_PLACEHOLDER = "Enter your api key"
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY', API_KEY_PLACEHOLDER)
 GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent"
 
+# Request deadline configuration
+REQUEST_TIMEOUT_HEADER = 'X-Request-Timeout'  # Overall budget in seconds, set by the client
+DEFAULT_REQUEST_TIMEOUT = 45.0
+MAX_REQUEST_TIMEOUT = 120.0
+DISCONNECT_POLL_INTERVAL = 0.1
+
+# Token accounting: local prompt estimate, prompt budget and cost per million tokens
+CHARS_PER_TOKEN = 4
+MAX_PROMPT_TOKENS = int(os.environ.get('CHATBOT_MAX_PROMPT_TOKENS', '8000'))
+INPUT_COST_PER_MTOK = float(os.environ.get('CHATBOT_INPUT_COST_PER_MTOK', '0.075'))
+OUTPUT_COST_PER_MTOK = float(os.environ.get('CHATBOT_OUTPUT_COST_PER_MTOK', '0.30'))
+SESSION_HEADER = 'X-Session-Id'
+USAGE_MAX_SESSIONS = 1000
+USAGE_RECENT_REQUESTS = 500
+ADMIN_TOKEN = os.environ.get('CHATBOT_ADMIN_TOKEN', '')
+
+# Static files and saved conversations live next to this script unless configured otherwise
+STATIC_DIR = os.path.dirname(os.path.abspath(__file__))
+CONVERSATIONS_DIR = Path(os.environ.get('CHATBOT_CONVERSATIONS_DIR', os.path.join(STATIC_DIR, 'conversations')))
+
+# Response compression: bodies smaller than this are sent as-is
+COMPRESSION_MIN_BYTES = 1024
+
+# Circuit breaker and hedging configuration for DuckDuckGo and Wikipedia
+CIRCUIT_FAILURE_THRESHOLD = 5  # Consecutive failures before the circuit opens
+CIRCUIT_RESET_TIMEOUT = 30.0  # Seconds to stay open before allowing a trial request
+STALE_CACHE_TTL = 3600.0  # Oldest cached result served while a circuit is open
+STALE_CACHE_SIZE = 256
+HEDGE_ENABLED = True
+HEDGE_MIN_SAMPLES = 20  # Latency samples needed before the p95 hedge delay is trusted
+HEDGE_MIN_DELAY = 0.05
+
+# Tool-augmented chat: when to ground a message in search results, and how much to inject.
+# Only time-sensitive questions trigger a search; general knowledge is answered directly.
+GROUNDING_TRIGGERS = re.compile(
+    r"\b(latest|currently|today|tonight|yesterday|this (week|month|year)|right now|news|recent(ly)?|"
+    r"weather|forecast|stock price|exchange rate|scores?)\b",
+    re.IGNORECASE
+)
+GROUNDING_LATENCY_BUDGET = 2.0  # Max seconds a grounded chat waits for search before Gemini is called
+GROUNDING_MAX_SNIPPETS = 5
+GROUNDING_SNIPPET_CHARS = 400
+
+# Debugging: slow-request span traces and the opt-in sampling profiler
+SLOW_REQUEST_THRESHOLD = float(os.environ.get('CHATBOT_SLOW_REQUEST_SECONDS', '2.0'))
+PROFILER_ENABLED = os.environ.get('CHATBOT_ENABLE_PROFILER', '') == '1'
+PROFILE_SAMPLE_INTERVAL = 0.005
+PROFILE_MAX_SECONDS = 60
+
+# Leaf frames of threads parked waiting for work; the profiler leaves them out
+PROFILE_IDLE_FRAMES = {
+    ('thread.py', '_worker'),
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('selectors.py', 'select')
+}
+
+# Upstream calls run here so the handler thread can keep watching the client socket
+upstream_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='upstream')
+
+# Separate pool for hedged attempts so they never wait behind the work that spawned them
+hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='hedge')
+
+# Web and Wikipedia lookups for grounded chats run side by side here
+grounding_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='grounding')
+
+# Counters for upstream work abandoned because of disconnects or expired deadlines
+request_metrics = {
+    'requests_cancelled': 0,
+    'deadlines_exceeded': 0,
+    'upstream_calls_skipped': 0,
+    'upstream_seconds_saved': 0.0,
+    'circuit_rejections': 0,
+    'stale_served': 0,
+    'hedged_requests': 0,
+    'hedge_wins': 0,
+    'grounded_chats': 0,
+    'grounding_budget_missed': 0,
+    'prompts_trimmed': 0,
+    'prompts_rejected': 0
+}
+metrics_lock = threading.Lock()
+
+def record_metric(name, amount=1):
+    """Increment a request metric counter"""
+    with metrics_lock:
+        request_metrics[name] += amount
+
+class RequestCancelled(Exception):
+    """Raised when a request is abandoned before its upstream work finishes"""
+
+    def __init__(self, reason, disconnected=False):
+        super().__init__(reason)
+        self.disconnected = disconnected
+
+class RequestDeadline:
+    """Overall time budget for one request, shared by every upstream call it makes"""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+        self.cancelled = threading.Event()
+        self.disconnected = False
+        self.exceeded_recorded = False
+        self.active_calls = {}
+        self.sockets = []
+        self.http_session = None
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def session(self):
+        """Return this request's HTTP session, whose sockets are shut down on cancel"""
+        with self.lock:
+            if self.http_session is None:
+                self.http_session = build_cancellable_session(self)
+            return self.http_session
+
+    def register_socket(self, sock):
+        """Remember an upstream socket so cancel() can abort a call blocked on it"""
+        with self.lock:
+            self.sockets.append(sock)
+        if self.cancelled.is_set():
+            abort_socket(sock)
+
+    def cancel(self, disconnected=True):
+        """Abort in-flight upstream calls and skip any that have not started yet"""
+        with self.lock:
+            if self.cancelled.is_set():
+                return
+            self.disconnected = disconnected
+            self.cancelled.set()
+            active_calls = list(self.active_calls.values())
+            sockets = list(self.sockets)
+        
+        # Only the waiting cut short on calls that were actually in flight counts as saved
+        now = time.monotonic()
+        saved = sum(max(0.0, expires_at - now) for expires_at in active_calls)
+        if saved > 0:
+            record_metric('upstream_seconds_saved', saved)
+        for sock in sockets:
+            abort_socket(sock)
+
+    def close(self):
+        """Release the HTTP session once the request is finished"""
+        with self.lock:
+            http_session = self.http_session
+        if http_session is not None:
+            http_session.close()
+
+    def exceeded(self):
+        """Build the deadline error, counting each request's expiry only once"""
+        with self.lock:
+            first = not self.exceeded_recorded
+            self.exceeded_recorded = True
+        if first:
+            record_metric('deadlines_exceeded')
+        return RequestCancelled('deadline exceeded')
+
+    def cancellation(self):
+        """Build the error matching the reason this request was cancelled"""
+        if self.disconnected:
+            return RequestCancelled('client disconnected', disconnected=True)
+        return self.exceeded()
+
+    def timeout(self, cap):
+        """Return the timeout for the next upstream call, bounded by the remaining budget"""
+        if self.cancelled.is_set():
+            record_metric('upstream_calls_skipped')
+            if self.disconnected:
+                record_metric('upstream_seconds_saved', min(cap, self.remaining()))
+            raise self.cancellation()
+        remaining = self.remaining()
+        if remaining <= 0:
+            record_metric('upstream_calls_skipped')
+            raise self.exceeded()
+        return min(cap, remaining)
+
+    @contextmanager
+    def track_call(self, timeout):
+        """Mark an upstream call as in flight until the block exits"""
+        token = object()
+        with self.lock:
+            self.active_calls[token] = time.monotonic() + timeout
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active_calls.pop(token, None)
+
+def abort_socket(sock):
+    """Shut down a socket so a thread blocked reading from it returns immediately"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+def build_cancellable_session(deadline):
+    """Create a requests Session that registers every socket it opens with the deadline"""
+    from requests.adapters import HTTPAdapter
+    from urllib3.connection import HTTPConnection, HTTPSConnection
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def tracked(connection_class):
+        class TrackedConnection(connection_class):
+            def connect(self):
+                super().connect()
+                deadline.register_socket(self.sock)
+        return TrackedConnection
+
+    class TrackedHTTPConnectionPool(HTTPConnectionPool):
+        ConnectionCls = tracked(HTTPConnection)
+
+    class TrackedHTTPSConnectionPool(HTTPSConnectionPool):
+        ConnectionCls = tracked(HTTPSConnection)
+
+    class CancellableAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            super().init_poolmanager(*args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {
+                'http': TrackedHTTPConnectionPool,
+                'https': TrackedHTTPSConnectionPool
+            }
+
+    session = requests.Session()
+    adapter = CancellableAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+class CircuitOpenError(Exception):
+    """Raised when an upstream's circuit breaker is rejecting calls"""
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker for one upstream API, with a stale result cache"""
+
+    def __init__(self, name):
+        self.name = name
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.latencies = deque(maxlen=100)
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def allow_request(self):
+        """Return True if a call may go upstream, moving open -> half-open after the reset timeout"""
+        with self.lock:
+            if self.state == 'open':
+                if time.monotonic() - self.opened_at < CIRCUIT_RESET_TIMEOUT:
+                    return False
+                self.state = 'half-open'
+                self.trial_in_flight = False
+            if self.state == 'half-open':
+                # Only one trial request probes a recovering upstream
+                if self.trial_in_flight:
+                    return False
+                self.trial_in_flight = True
+            return True
+
+    def record_success(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.failures = 0
+            self.trial_in_flight = False
+            if self.state != 'closed':
+                print(f"✅ {self.name} recovered, circuit closed")
+            self.state = 'closed'
+
+    def release_trial(self):
+        """Free the half-open trial slot without judging the upstream, e.g. when the trial was cancelled"""
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.state == 'half-open' or self.failures >= CIRCUIT_FAILURE_THRESHOLD:
+                if self.state != 'open':
+                    print(f"⚡ {self.name} is failing, circuit opened for {CIRCUIT_RESET_TIMEOUT:.0f}s")
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+    def hedge_delay(self):
+        """Return the p95 latency to wait before hedging, or None if hedging should not happen"""
+        with self.lock:
+            if self.state != 'closed' or len(self.latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self.latencies)
+        return max(HEDGE_MIN_DELAY, ordered[int(len(ordered) * 0.95) - 1])
+
+    def store_result(self, key, result):
+        with self.lock:
+            self.cache[key] = (time.monotonic(), result)
+            self.cache.move_to_end(key)
+            while len(self.cache) > STALE_CACHE_SIZE:
+                self.cache.popitem(last=False)
+
+    def stale_result(self, key):
+        """Return a cached result for key while the circuit is rejecting calls, or None"""
+        with self.lock:
+            open_and_waiting = self.state == 'open' and time.monotonic() - self.opened_at < CIRCUIT_RESET_TIMEOUT
+            trial_running = self.state == 'half-open' and self.trial_in_flight
+            if not (open_and_waiting or trial_running):
+                return None
+        return self.cached_result(key)
+
+    def cached_result(self, key):
+        """Return a cached result for key regardless of circuit state, or None"""
+        with self.lock:
+            cached = self.cache.get(key)
+        if not cached or time.monotonic() - cached[0] > STALE_CACHE_TTL:
+            return None
+        record_metric('stale_served')
+        return dict(cached[1], status='stale')
+
+class RequestTrace:
+    """Timed spans for one request, logged when the request is slower than the threshold"""
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.started = time.monotonic()
+        self.spans = []
+
+    @contextmanager
+    def span(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, started)
+
+    def record(self, name, started):
+        self.spans.append((name, time.monotonic() - started))
+
+    def finish(self):
+        elapsed = time.monotonic() - self.started
+        if elapsed < SLOW_REQUEST_THRESHOLD:
+            return
+        steps = ' → '.join(f"{name} {duration * 1000:.1f}ms" for name, duration in self.spans)
+        print(f"🐢 Slow request {self.method} {self.path} took {elapsed:.2f}s: {steps or 'no spans recorded'}")
+
+profile_lock = threading.Lock()
+
+def sample_profile(duration):
+    """Sample busy threads' wall-clock stacks for duration seconds and return flamegraph collapsed stacks"""
+    own_thread = threading.get_ident()
+    counts = Counter()
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            # Threads blocked on upstream sockets are kept; threads waiting for work are not
+            if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in PROFILE_IDLE_FRAMES:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(thread_names.get(thread_id, str(thread_id)))
+            counts[';'.join(reversed(stack))] += 1
+        time.sleep(PROFILE_SAMPLE_INTERVAL)
+    return ''.join(f"{stack} {count}\n" for stack, count in counts.most_common())
+
+circuit_breakers = {
+    'duckduckgo': CircuitBreaker('DuckDuckGo'),
+    'wikipedia': CircuitBreaker('Wikipedia')
+}
+
+def estimate_tokens(text):
+    """Cheap local token estimate, about four characters per token for English text"""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+class UsageTracker:
+    """Per-session and aggregate token, cost and latency accounting for Gemini calls"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = self.empty_totals()
+        self.sessions = OrderedDict()
+        self.recent = deque(maxlen=USAGE_RECENT_REQUESTS)
+
+    @staticmethod
+    def empty_totals():
+        return {
+            'requests': 0,
+            'estimated_prompt_tokens': 0,
+            'prompt_tokens': 0,
+            'output_tokens': 0,
+            'total_tokens': 0,
+            'cost_usd': 0.0,
+            'latency_seconds': 0.0
+        }
+
+    def record(self, session_id, estimated_prompt_tokens, usage_metadata, latency, status_code):
+        """Record one Gemini call using the usageMetadata Gemini returned"""
+        prompt_tokens = usage_metadata.get('promptTokenCount', 0)
+        output_tokens = usage_metadata.get('candidatesTokenCount', 0)
+        entry = {
+            'time': datetime.now().isoformat(),
+            'session': session_id,
+            'status': status_code,
+            'estimated_prompt_tokens': estimated_prompt_tokens,
+            'prompt_tokens': prompt_tokens,
+            'output_tokens': output_tokens,
+            'total_tokens': usage_metadata.get('totalTokenCount', prompt_tokens + output_tokens),
+            'cost_usd': (prompt_tokens * INPUT_COST_PER_MTOK + output_tokens * OUTPUT_COST_PER_MTOK) / 1_000_000,
+            'latency_seconds': latency
+        }
+        
+        with self.lock:
+            if session_id not in self.sessions:
+                self.sessions[session_id] = self.empty_totals()
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > USAGE_MAX_SESSIONS:
+                self.sessions.popitem(last=False)
+            
+            for totals in (self.totals, self.sessions[session_id]):
+                totals['requests'] += 1
+                for key in ('prompt_tokens', 'output_tokens', 'total_tokens', 'cost_usd', 'latency_seconds'):
+                    totals[key] += entry[key]
+                # Only metered calls count toward the estimate, so estimate_ratio compares like with like
+                if 'promptTokenCount' in usage_metadata:
+                    totals['estimated_prompt_tokens'] += estimated_prompt_tokens
+            self.recent.append(entry)
+
+    def report(self, top=10):
+        """Summarize usage overall, per session, and the costliest and slowest recent requests"""
+        with self.lock:
+            totals = dict(self.totals)
+            sessions = {session_id: dict(session) for session_id, session in self.sessions.items()}
+            recent = list(self.recent)
+        
+        for summary in [totals] + list(sessions.values()):
+            requests_made = summary['requests'] or 1
+            summary['avg_total_tokens'] = summary['total_tokens'] / requests_made
+            summary['avg_latency_seconds'] = summary['latency_seconds'] / requests_made
+            # Actual / estimated prompt tokens, to check the local estimator
+            if summary['estimated_prompt_tokens']:
+                summary['estimate_ratio'] = summary['prompt_tokens'] / summary['estimated_prompt_tokens']
+        
+        return {
+            'totals': totals,
+            'sessions': dict(sorted(sessions.items(), key=lambda item: item[1]['total_tokens'], reverse=True)),
+            'top_by_tokens': sorted(recent, key=lambda entry: entry['total_tokens'], reverse=True)[:top],
+            'top_by_latency': sorted(recent, key=lambda entry: entry['latency_seconds'], reverse=True)[:top],
+            'limits': {
+                'max_prompt_tokens': MAX_PROMPT_TOKENS,
+                'input_cost_per_mtok': INPUT_COST_PER_MTOK,
+                'output_cost_per_mtok': OUTPUT_COST_PER_MTOK
+            }
+        }
+
+usage_tracker = UsageTracker()
+
+class ServerState:
+    """Readiness and in-flight request tracking, so shutdown can drain requests"""
+
+    def __init__(self):
+        self.ready = False
+        self.draining = False
+        self.in_flight = 0
+        self.deadlines = set()
+        self.condition = threading.Condition()
+
+    def begin_request(self):
+        with self.condition:
+            self.in_flight += 1
+
+    def end_request(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def track_deadline(self, deadline):
+        with self.condition:
+            self.deadlines.add(deadline)
+
+    def untrack_deadline(self, deadline):
+        with self.condition:
+            self.deadlines.discard(deadline)
+
+    def cancel_requests(self):
+        """Abort the upstream work of every request still being handled"""
+        with self.condition:
+            deadlines = list(self.deadlines)
+        for deadline in deadlines:
+            deadline.cancel(disconnected=False)
+
+    def wait_for_drain(self, timeout):
+        """Wait until no requests are in flight; returns False if the timeout ran out first"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.in_flight == 0, timeout)
+
+server_state = ServerState()
+
 class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
-    # Class variable to store uploaded file contexts
+    # Class variable to store uploaded file contexts, shared by every handler thread
     uploaded_files_context = {}
+    uploaded_files_lock = threading.Lock()
     
     def log_message(self, format, *args):
         """Override to suppress HTTP request logs and add custom messages"""
         # Suppress default HTTP logs and add custom messages
         if "GET" in args[0]:
-            if "favicon.ico" not in args[0]:
+            if not any(path in args[0] for path in ("favicon.ico", "/healthz", "/readyz")):
                 print(f"🌐 User accessed the chatbot interface")
         elif "POST" in args[0]:
             if "/chat" in args[0]:
@@ -45,64 +594,346 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
     
     def do_GET(self):
         """Handle GET requests"""
-        if self.path == '/':
-            self.path = '/index.html'
-        return http.server.SimpleHTTPRequestHandler.do_GET(self)
+        self.trace = RequestTrace('GET', self.path)
+        url = urllib.parse.urlsplit(self.path)
+        try:
+            if url.path == '/':
+                self.path = '/index.html'
+            elif url.path == '/healthz':
+                self.send_json_response({'status': 'ok'})
+                return
+            elif url.path == '/readyz':
+                self.handle_readiness()
+                return
+            elif url.path == '/admin/usage':
+                self.handle_usage_report()
+                return
+            elif url.path == '/metrics':
+                with metrics_lock:
+                    metrics = dict(request_metrics)
+                metrics['circuits'] = {name: breaker.state for name, breaker in circuit_breakers.items()}
+                self.send_json_response(metrics)
+                return
+            elif url.path == '/debug/profile' and PROFILER_ENABLED:
+                self.handle_profile(urllib.parse.parse_qs(url.query))
+                return
+            return http.server.SimpleHTTPRequestHandler.do_GET(self)
+        finally:
+            self.trace.finish()
     
     def do_POST(self):
         """Handle POST requests"""
-        if self.path == '/chat':
-            self.handle_chat()
-        elif self.path == '/search':
-            self.handle_search()
-        elif self.path == '/upload':
-            self.handle_file_upload()
-        elif self.path == '/wikipedia':
-            self.handle_wikipedia_search()
-        elif self.path == '/save-conversation':
-            self.handle_save_conversation()
-        elif self.path == '/load-conversation':
-            self.handle_load_conversation()
-        elif self.path == '/list-conversations':
-            self.handle_list_conversations()
-        elif self.path == '/delete-conversation':
-            self.handle_delete_conversation()
+        self.deadline = self.parse_request_deadline()
+        self.trace = RequestTrace('POST', self.path)
+        server_state.track_deadline(self.deadline)
+        
+        try:
+            if server_state.draining:
+                # Finish what's in flight but turn away new work during shutdown
+                self.close_connection = True
+                self.send_json_response({'error': 'Server is shutting down'}, 503)
+            elif self.path == '/chat':
+                self.handle_chat()
+            elif self.path == '/search':
+                self.handle_search()
+            elif self.path == '/upload':
+                self.handle_file_upload()
+            elif self.path == '/wikipedia':
+                self.handle_wikipedia_search()
+            elif self.path == '/save-conversation':
+                self.handle_save_conversation()
+            elif self.path == '/load-conversation':
+                self.handle_load_conversation()
+            elif self.path == '/list-conversations':
+                self.handle_list_conversations()
+            elif self.path == '/delete-conversation':
+                self.handle_delete_conversation()
+            else:
+                self.send_error(404)
+        finally:
+            server_state.untrack_deadline(self.deadline)
+            self.deadline.close()
+            self.trace.finish()
+    
+    def handle_usage_report(self):
+        """Report token, cost and latency usage to local clients, or to anyone holding CHATBOT_ADMIN_TOKEN"""
+        if ADMIN_TOKEN:
+            authorization = self.headers.get('Authorization', '').encode('utf-8')
+            if not hmac.compare_digest(authorization, f'Bearer {ADMIN_TOKEN}'.encode('utf-8')):
+                self.send_json_response({'error': 'Unauthorized'}, 401)
+                return
+        elif not ipaddress.ip_address(self.client_address[0]).is_loopback:
+            self.send_json_response({'error': 'Set CHATBOT_ADMIN_TOKEN to allow remote access'}, 403)
+            return
+        self.send_json_response(usage_tracker.report())
+    
+    def session_id(self):
+        """Identify the browser session a request belongs to, for usage accounting"""
+        return (self.headers.get(SESSION_HEADER) or 'anonymous')[:64]
+    
+    def handle_readiness(self):
+        """Report whether the server should receive traffic"""
+        checks = {
+            'upstream_client_loaded': requests.is_loaded(),
+            'api_key_configured': bool(GEMINI_API_KEY) and GEMINI_API_KEY != API_KEY_PLACEHOLDER,
+            'accepting_requests': server_state.ready and not server_state.draining
+        }
+        ready = all(checks.values())
+        self.send_json_response({'status': 'ready' if ready else 'not ready', 'checks': checks}, 200 if ready else 503)
+    
+    def read_json_body(self):
+        """Read and decode the JSON request body"""
+        with self.trace.span('parse'):
+            content_length = int(self.headers['Content-Length'])
+            post_data = self.rfile.read(content_length)
+            return json.loads(post_data.decode('utf-8'))
+    
+    def handle_profile(self, query):
+        """Capture a sampled wall-clock profile of the running server"""
+        try:
+            seconds = min(max(float(query.get('seconds', ['10'])[0]), 1), PROFILE_MAX_SECONDS)
+        except ValueError:
+            self.send_json_response({'error': 'Invalid seconds parameter'}, 400)
+            return
+        
+        if not profile_lock.acquire(blocking=False):
+            self.send_json_response({'error': 'A profile is already being captured'}, 409)
+            return
+        try:
+            print(f"🔬 Capturing {seconds:.0f}s wall-clock profile...")
+            collapsed_stacks = sample_profile(seconds)
+        finally:
+            profile_lock.release()
+        
+        body = collapsed_stacks.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def parse_request_deadline(self):
+        """Build the request deadline from the client's timeout header"""
+        budget = DEFAULT_REQUEST_TIMEOUT
+        header_value = self.headers.get(REQUEST_TIMEOUT_HEADER)
+        if header_value:
+            try:
+                budget = float(header_value)
+            except ValueError:
+                pass
+        if not 0 < budget <= MAX_REQUEST_TIMEOUT:
+            budget = DEFAULT_REQUEST_TIMEOUT if budget <= 0 else MAX_REQUEST_TIMEOUT
+        return RequestDeadline(budget)
+    
+    def client_disconnected(self):
+        """Check whether the client has closed its side of the connection"""
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if not readable:
+                return False
+            # A readable socket with no pending data means the peer hung up
+            return self.connection.recv(1, socket.MSG_PEEK) == b''
+        except (OSError, ValueError):
+            return True
+    
+    def run_upstream(self, func, *args):
+        """Run upstream work in the worker pool, abandoning it on disconnect or deadline"""
+        future = upstream_executor.submit(func, *args)
+        while True:
+            try:
+                return future.result(timeout=DISCONNECT_POLL_INTERVAL)
+            except FutureTimeoutError:
+                pass
+            
+            if self.client_disconnected():
+                record_metric('requests_cancelled')
+                self.deadline.cancel(disconnected=True)
+            elif self.deadline.expired():
+                self.deadline.cancel(disconnected=False)
+            else:
+                continue
+            
+            # cancel() has aborted the running call and stops any further upstream calls
+            raise self.deadline.cancellation()
+    
+    def upstream_get(self, breaker, url, params=None, cap=10):
+        """GET an upstream URL through its circuit breaker, failing fast while it is open"""
+        timeout = self.deadline.timeout(cap)
+        if not breaker.allow_request():
+            record_metric('circuit_rejections')
+            raise CircuitOpenError(f'{breaker.name} is temporarily unavailable')
+        
+        started = time.monotonic()
+        try:
+            with self.trace.span(f'upstream:{breaker.name}'):
+                response = self.hedged_get(breaker, url, params, timeout)
+        except Exception as e:
+            try:
+                self.raise_if_cancelled(e)
+            except RequestCancelled:
+                # Calls we aborted ourselves say nothing about the upstream's health,
+                # but a cancelled half-open trial must let the next call probe again
+                breaker.release_trial()
+                raise
+            breaker.record_failure()
+            raise
+        
+        if response.status_code >= 500 or response.status_code == 429:
+            breaker.record_failure()
         else:
-            self.send_error(404)
+            breaker.record_success(time.monotonic() - started)
+        return response
+    
+    def hedged_get(self, breaker, url, params, timeout):
+        """Send a second attempt if the first is slower than the upstream's p95 latency"""
+        delay = breaker.hedge_delay() if HEDGE_ENABLED else None
+        if delay is None or delay >= timeout:
+            return self.tracked_get(url, params, timeout)
+        
+        first = hedge_executor.submit(self.tracked_get, url, params, timeout)
+        try:
+            return first.result(timeout=delay)
+        except FutureTimeoutError:
+            pass
+        
+        record_metric('hedged_requests')
+        second = hedge_executor.submit(self.tracked_get, url, params, max(HEDGE_MIN_DELAY, timeout - delay))
+        error = None
+        for attempt in as_completed([first, second]):
+            try:
+                response = attempt.result()
+            except Exception as e:
+                # Keep waiting for the other attempt
+                error = e
+                continue
+            if attempt is second:
+                record_metric('hedge_wins')
+            return response
+        raise error
+    
+    def tracked_get(self, url, params, timeout):
+        """GET through the request's session so a cancel can abort the call mid-flight"""
+        with self.deadline.track_call(timeout):
+            return self.deadline.session().get(url, params=params, timeout=timeout)
+    
+    def raise_if_cancelled(self, error):
+        """Re-raise upstream errors caused by our own cancel or an expired deadline as RequestCancelled"""
+        if self.deadline.cancelled.is_set():
+            raise self.deadline.cancellation() from error
+        if isinstance(error, requests.exceptions.Timeout) and self.deadline.expired():
+            raise self.deadline.exceeded() from error
+    
+    def handle_cancelled(self, error):
+        """Finish a request whose upstream work was abandoned"""
+        if error.disconnected:
+            # Nobody is listening, so skip writing the response
+            print(f"🚫 Client disconnected, upstream work cancelled")
+            self.close_connection = True
+        else:
+            self.send_json_response({'error': f'Request {error}'}, 504)
     
     def handle_chat(self):
         """Handle chat API requests"""
         try:
             # Get request data
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json_body()
             
             user_message = data.get('message', '')
             clear_context = data.get('clear_context', False)
+            grounding = data.get('grounding', False)
             
             if not user_message:
                 self.send_json_response({'error': 'No message provided'}, 400)
                 return
             
+            # Reject messages that can never fit the prompt budget before doing any upstream work
+            estimated_tokens = estimate_tokens(user_message)
+            if estimated_tokens > MAX_PROMPT_TOKENS:
+                record_metric('prompts_rejected')
+                self.send_json_response({
+                    'error': f'Message is too long (about {estimated_tokens} tokens, limit is {MAX_PROMPT_TOKENS})'
+                }, 413)
+                return
+            
             # Clear file context if requested
             if clear_context:
-                self.uploaded_files_context.clear()
+                with self.uploaded_files_lock:
+                    self.uploaded_files_context.clear()
+            
+            # Let the server search first when the message looks like it needs fresh facts
+            if grounding and self.needs_grounding(user_message):
+                response_text, sources = self.run_upstream(self.get_grounded_response, user_message)
+                self.send_json_response({'response': response_text, 'sources': sources})
+                return
             
             # Get response from Gemini API
-            response_text = self.get_gemini_response(user_message)
+            response_text = self.run_upstream(self.get_gemini_response, user_message)
             self.send_json_response({'response': response_text})
             
+        except RequestCancelled as e:
+            self.handle_cancelled(e)
         except Exception as e:
             self.send_json_response({'error': f'Server error: {str(e)}'}, 500)
     
+    def needs_grounding(self, message):
+        """Decide whether a chat message should be grounded in web and Wikipedia results"""
+        # Questions about uploaded files are answered from the file context instead
+        if self.uploaded_files_context or len(message) < 12:
+            return False
+        return bool(GROUNDING_TRIGGERS.search(message))
+    
+    def get_grounded_response(self, message):
+        """Search the web and Wikipedia in parallel for up to the latency budget, then answer with the merged snippets"""
+        record_metric('grounded_chats')
+        searches = [
+            grounding_executor.submit(self.perform_web_search, message),
+            grounding_executor.submit(self.search_wikipedia, message)
+        ]
+        budget = min(GROUNDING_LATENCY_BUDGET, self.deadline.remaining())
+        done, not_done = wait(searches, timeout=budget)
+        if not_done:
+            # Generate with whatever arrived in time; late results still warm the stale cache
+            record_metric('grounding_budget_missed')
+            print(f"⏱️ Search missed its {budget:.1f}s budget, answering with the results so far")
+        
+        sources = self.merge_search_results([search.result() for search in searches if search in done])
+        grounding_context = ''
+        if sources:
+            grounding_context = "\n\n=== WEB SEARCH CONTEXT ===\n"
+            for index, source in enumerate(sources, 1):
+                grounding_context += f"\n[{index}] {source['title']} ({source['url']})\n{source['snippet']}\n"
+            grounding_context += "=== END WEB SEARCH CONTEXT ===\n\n"
+        
+        return self.get_gemini_response(message, grounding_context), sources
+    
+    def merge_search_results(self, search_responses):
+        """Merge web and Wikipedia results into a short, de-duplicated list of trimmed snippets"""
+        sources = []
+        seen_urls = set()
+        for search_response in search_responses:
+            if search_response.get('status') == 'error':
+                continue
+            for result in search_response.get('results', []):
+                url = result.get('url', '#')
+                # Skip the "search it yourself" placeholders returned when nothing was found
+                if url == '#' or url in seen_urls or 'google.com/search' in url or 'Special:Search' in url:
+                    continue
+                text = (result.get('snippet') or result.get('summary') or '').strip()
+                if not text:
+                    continue
+                seen_urls.add(url)
+                sources.append({
+                    'title': result.get('title', ''),
+                    'snippet': text[:GROUNDING_SNIPPET_CHARS] + ('...' if len(text) > GROUNDING_SNIPPET_CHARS else ''),
+                    'url': url
+                })
+        return sources[:GROUNDING_MAX_SNIPPETS]
+    
     def handle_search(self):
         """Handle search API requests with real Google search"""
         try:
             # Get request data
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json_body()
             
             query = data.get('query', '')
             if not query:
@@ -110,14 +941,21 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
                 return
             
             # Real web search using requests
-            search_results = self.perform_web_search(query)
+            search_results = self.run_upstream(self.perform_web_search, query)
             self.send_json_response(search_results)
             
+        except RequestCancelled as e:
+            self.handle_cancelled(e)
         except Exception as e:
             self.send_json_response({'error': f'Search error: {str(e)}'}, 500)
     
     def perform_web_search(self, query):
         """Perform actual web search"""
+        breaker = circuit_breakers['duckduckgo']
+        stale_results = breaker.stale_result(query)
+        if stale_results:
+            return stale_results
+        
         try:
             # Use DuckDuckGo instant answers API (free and no API key required)
             search_url = f"https://api.duckduckgo.com/"
@@ -128,7 +966,7 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
                 'skip_disambig': '1'
             }
             
-            response = requests.get(search_url, params=params, timeout=10)
+            response = self.upstream_get(breaker, search_url, params=params, cap=10)
             
             if response.status_code == 200:
                 data = response.json()
@@ -161,11 +999,13 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
                         'url': f'https://www.google.com/search?q={urllib.parse.quote(query)}'
                     })
                 
-                return {
+                search_results = {
                     'query': query,
                     'results': results,
                     'status': 'success'
                 }
+                breaker.store_result(query, search_results)
+                return search_results
             
             else:
                 return {
@@ -178,7 +1018,13 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
                     'status': 'error'
                 }
                 
+        except RequestCancelled:
+            raise
         except Exception as e:
+            # A rejecting breaker can still answer from the cache
+            stale_results = breaker.cached_result(query) if isinstance(e, CircuitOpenError) else None
+            if stale_results:
+                return stale_results
             return {
                 'query': query,
                 'results': [{
@@ -193,12 +1039,7 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
         """Handle file upload requests"""
         try:
             # Get request data
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            
-            # Parse multipart form data (simplified version)
-            # In a production environment, you'd use a proper multipart parser
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json_body()
             
             file_data = data.get('fileData', '')
             file_name = data.get('fileName', 'unknown')
@@ -209,16 +1050,20 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
                 return
             
             # Process the file
-            file_content = self.process_uploaded_file(file_data, file_name, file_type)
+            with self.trace.span('decode'):
+                file_content = self.process_uploaded_file(file_data, file_name, file_type)
             
             # Store file context for future reference
-            self.uploaded_files_context[file_name] = {
-                'content': file_content,
-                'file_type': file_type,
-                'file_name': file_name,
-                'upload_time': datetime.now().isoformat(),
-                'raw_content': self.extract_raw_content(file_data, file_name, file_type)
-            }
+            with self.trace.span('extract'):
+                raw_content = self.extract_raw_content(file_data, file_name, file_type)
+            with self.uploaded_files_lock:
+                self.uploaded_files_context[file_name] = {
+                    'content': file_content,
+                    'file_type': file_type,
+                    'file_name': file_name,
+                    'upload_time': datetime.now().isoformat(),
+                    'raw_content': raw_content
+                }
             
             # Send response
             self.send_json_response({
@@ -447,9 +1292,7 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
         """Handle Wikipedia search requests"""
         try:
             # Get request data
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json_body()
             
             query = data.get('query', '')
             if not query:
@@ -457,14 +1300,21 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
                 return
             
             # Search Wikipedia
-            wikipedia_results = self.search_wikipedia(query)
+            wikipedia_results = self.run_upstream(self.search_wikipedia, query)
             self.send_json_response(wikipedia_results)
             
+        except RequestCancelled as e:
+            self.handle_cancelled(e)
         except Exception as e:
             self.send_json_response({'error': f'Wikipedia search error: {str(e)}'}, 500)
     
     def search_wikipedia(self, query):
         """Search Wikipedia for articles"""
+        breaker = circuit_breakers['wikipedia']
+        stale_results = breaker.stale_result(query)
+        if stale_results:
+            return stale_results
+        
         try:
             # Wikipedia API endpoint
             wikipedia_api = "https://en.wikipedia.org/api/rest_v1/page/summary/"
@@ -479,7 +1329,7 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
                 'srlimit': 3
             }
             
-            search_response = requests.get(search_api, params=search_params, timeout=10)
+            search_response = self.upstream_get(breaker, search_api, params=search_params, cap=10)
             
             if search_response.status_code == 200:
                 search_data = search_response.json()
@@ -493,7 +1343,7 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
                         # Get detailed summary for each article
                         try:
                             summary_url = f"{wikipedia_api}{urllib.parse.quote(title)}"
-                            summary_response = requests.get(summary_url, timeout=5)
+                            summary_response = self.upstream_get(breaker, summary_url, cap=5)
                             
                             if summary_response.status_code == 200:
                                 summary_data = summary_response.json()
@@ -512,6 +1362,8 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
                                     'thumbnail': ''
                                 })
                                 
+                        except RequestCancelled:
+                            raise
                         except Exception as e:
                             # Fallback to basic info
                             results.append({
@@ -529,12 +1381,14 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
                         'thumbnail': ''
                     })
                 
-                return {
+                wikipedia_results = {
                     'query': query,
                     'results': results,
                     'source': 'Wikipedia',
                     'status': 'success'
                 }
+                breaker.store_result(query, wikipedia_results)
+                return wikipedia_results
             
             else:
                 return {
@@ -549,7 +1403,13 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
                     'status': 'error'
                 }
                 
+        except RequestCancelled:
+            raise
         except Exception as e:
+                # A rejecting breaker can still answer from the cache
+                stale_results = breaker.cached_result(query) if isinstance(e, CircuitOpenError) else None
+                if stale_results:
+                    return stale_results
                 return {
                     'query': query,
                     'results': [{
@@ -565,15 +1425,13 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
     def handle_save_conversation(self):
         """Handle conversation save requests"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json_body()
             
             conversation_name = data.get('name', f'Conversation_{datetime.now().strftime("%Y%m%d_%H%M%S")}')
             messages = data.get('messages', [])
             
             # Create conversations directory if it doesn't exist
-            conversations_dir = Path('conversations')
+            conversations_dir = CONVERSATIONS_DIR
             conversations_dir.mkdir(exist_ok=True)
             
             # Save conversation to file
@@ -599,28 +1457,51 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
     def handle_load_conversation(self):
         """Handle conversation load requests"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json_body()
             
             filename = data.get('filename', '')
             if not filename:
                 self.send_json_response({'error': 'No filename provided'}, 400)
                 return
             
-            conversation_file = Path('conversations') / f"{filename}.json"
+            # Optional paging: return the `limit` messages that come before index `before`
+            try:
+                limit = int(data['limit']) if data.get('limit') is not None else None
+                before = int(data['before']) if data.get('before') is not None else None
+            except (TypeError, ValueError):
+                self.send_json_response({'error': 'Invalid paging parameters'}, 400)
+                return
+            
+            conversation_file = CONVERSATIONS_DIR / f"{filename}.json"
             
             if not conversation_file.exists():
                 self.send_json_response({'error': 'Conversation not found'}, 404)
                 return
             
+            # Skip reading and re-serializing the file if the client already has it
+            validators = self.conversation_validators([conversation_file], variant=f"{limit}:{before}")
+            if limit is not None or before is not None:
+                # Every page shares the file's mtime, so only the page-specific ETag can validate it
+                validators = (validators[0], None)
+            if self.is_not_modified(*validators):
+                self.send_not_modified(*validators)
+                return
+            
             with open(conversation_file, 'r', encoding='utf-8') as f:
                 conversation_data = json.load(f)
             
+            messages = conversation_data.get('messages', [])
+            total = len(messages)
+            end = total if before is None else min(max(before, 0), total)
+            start = 0 if limit is None else max(end - max(limit, 0), 0)
+            conversation_data['messages'] = messages[start:end]
+            
             self.send_json_response({
                 'success': True,
-                'conversation': conversation_data
-            })
+                'conversation': conversation_data,
+                'offset': start,
+                'total': total
+            }, validators=validators)
             
         except Exception as e:
             self.send_json_response({'error': f'Load error: {str(e)}'}, 500)
@@ -628,11 +1509,18 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
     def handle_list_conversations(self):
         """Handle conversation list requests"""
         try:
-            conversations_dir = Path('conversations')
+            conversations_dir = CONVERSATIONS_DIR
             conversations = []
             
-            if conversations_dir.exists():
-                for conversation_file in conversations_dir.glob('*.json'):
+            # The listing only changes when a conversation file is added, removed or rewritten
+            conversation_files = list(conversations_dir.glob('*.json')) if conversations_dir.exists() else []
+            validators = self.conversation_validators(conversation_files)
+            if self.is_not_modified(*validators):
+                self.send_not_modified(*validators)
+                return
+            
+            if conversation_files:
+                for conversation_file in conversation_files:
                     try:
                         with open(conversation_file, 'r', encoding='utf-8') as f:
                             data = json.load(f)
@@ -653,7 +1541,7 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
             self.send_json_response({
                 'success': True,
                 'conversations': conversations
-            })
+            }, validators=validators)
             
         except Exception as e:
             self.send_json_response({'error': f'List error: {str(e)}'}, 500)
@@ -661,16 +1549,14 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
     def handle_delete_conversation(self):
         """Handle conversation delete requests"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json_body()
             
             filename = data.get('filename', '')
             if not filename:
                 self.send_json_response({'error': 'No filename provided'}, 400)
                 return
             
-            conversation_file = Path('conversations') / f"{filename}.json"
+            conversation_file = CONVERSATIONS_DIR / f"{filename}.json"
             
             if not conversation_file.exists():
                 self.send_json_response({'error': 'Conversation not found'}, 404)
@@ -686,16 +1572,22 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
         except Exception as e:
             self.send_json_response({'error': f'Delete error: {str(e)}'}, 500)
     
-    def get_gemini_response(self, message):
-        """Get response from Gemini API with file context"""
+    def get_gemini_response(self, message, grounding_context=''):
+        """Get response from Gemini API with file and search context"""
         try:
+            context_started = time.monotonic()
+            
             # Prepare the message with file context if available
             enhanced_message = message
+            context_info = ''
+            question = "User Question: " + message
             
             # Add file context if there are uploaded files
-            if self.uploaded_files_context:
+            with self.uploaded_files_lock:
+                uploaded_files = list(self.uploaded_files_context.items())
+            if uploaded_files:
                 context_info = "\n\n=== UPLOADED FILE CONTEXT ===\n"
-                for filename, file_info in self.uploaded_files_context.items():
+                for filename, file_info in uploaded_files:
                     context_info += f"\nFile: {filename} ({file_info['file_type']})\n"
                     
                     # Add raw content for text files
@@ -706,7 +1598,17 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
                         context_info += f"Content: [Binary file or content too large]\n"
                 
                 context_info += "=== END FILE CONTEXT ===\n\n"
-                enhanced_message = context_info + "User Question: " + message
+            
+            # Add search results gathered for grounded chats
+            if grounding_context:
+                context_info = grounding_context
+                question = "Use the search results above where relevant and cite them by number.\n\n" + question
+            
+            if context_info:
+                enhanced_message = self.fit_context_to_budget(context_info, question) + question
+            estimated_tokens = estimate_tokens(enhanced_message)
+            
+            self.trace.record('context', context_started)
             
             headers = {
                 'Content-Type': 'application/json',
@@ -744,16 +1646,25 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
                 ]
             }
             
-            response = requests.post(
-                f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
-                headers=headers,
-                json=payload,
-                timeout=30
+            timeout = self.deadline.timeout(30)
+            with self.trace.span('upstream:Gemini'), self.deadline.track_call(timeout):
+                response = self.deadline.session().post(
+                    f"{GEMINI_API_URL}?key={GEMINI_API_KEY}",
+                    headers=headers,
+                    json=payload,
+                    timeout=timeout
+                )
+            
+            result = response.json() if response.status_code == 200 else {}
+            usage_tracker.record(
+                self.session_id(),
+                estimated_tokens,
+                result.get('usageMetadata', {}),
+                time.monotonic() - self.trace.started,
+                response.status_code
             )
             
             if response.status_code == 200:
-                result = response.json()
-                
                 if 'candidates' in result and len(result['candidates']) > 0:
                     candidate = result['candidates'][0]
                     if 'content' in candidate and 'parts' in candidate['content']:
@@ -765,67 +1676,241 @@ class ChatBotHandler(http.server.SimpleHTTPRequestHandler):
             else:
                 return f"❌ Gemini API error: {response.status_code}"
                 
-        except requests.exceptions.Timeout:
+        except RequestCancelled:
+            raise
+        except requests.exceptions.Timeout as e:
+            self.raise_if_cancelled(e)
             return "❌ Request timeout. Please try again."
-        except requests.exceptions.ConnectionError:
+        except requests.exceptions.ConnectionError as e:
+            self.raise_if_cancelled(e)
             return "❌ Connection error. Please check your internet connection."
         except Exception as e:
+            self.raise_if_cancelled(e)
             return f"❌ Error: {str(e)}"
     
-    def send_json_response(self, data, status_code=200):
-        """Send JSON response"""
+    def fit_context_to_budget(self, context_info, question):
+        """Trim file or search context so the whole prompt stays within MAX_PROMPT_TOKENS"""
+        budget = MAX_PROMPT_TOKENS - estimate_tokens(question)
+        if estimate_tokens(context_info) <= budget:
+            return context_info
+        
+        record_metric('prompts_trimmed')
+        print(f"✂️ Prompt context trimmed to fit {MAX_PROMPT_TOKENS} tokens")
+        marker = "\n[Context trimmed to fit the prompt budget]\n\n"
+        keep_tokens = max(budget - estimate_tokens(marker), 0)
+        return context_info[:keep_tokens * CHARS_PER_TOKEN] + marker
+    
+    def send_json_response(self, data, status_code=200, validators=None):
+        """Send JSON response, compressed when the client accepts it"""
+        with self.trace.span('serialize'):
+            body = json.dumps(data).encode('utf-8')
+        
+        encoding = self.choose_content_encoding() if len(body) >= COMPRESSION_MIN_BYTES else None
+        if encoding:
+            with self.trace.span('compress'):
+                body = brotli.compress(body, quality=4) if encoding == 'br' else gzip.compress(body, compresslevel=6)
+        
         self.send_response(status_code)
         self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Vary', 'Accept-Encoding')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if validators:
+            self.send_validator_headers(*validators)
+        self.send_cors_headers()
         self.end_headers()
+        self.wfile.write(body)
+    
+    def choose_content_encoding(self):
+        """Pick br or gzip from the Accept-Encoding header, or None for identity"""
+        accepted = {}
+        for item in self.headers.get('Accept-Encoding', '').split(','):
+            coding, _, params = item.strip().partition(';')
+            quality = 1.0
+            if params.strip().startswith('q='):
+                try:
+                    quality = float(params.strip()[2:])
+                except ValueError:
+                    quality = 0.0
+            accepted[coding.strip().lower()] = quality
+        
+        if brotli is not None and accepted.get('br', 0) > 0:
+            return 'br'
+        if accepted.get('gzip', 0) > 0:
+            return 'gzip'
+        return None
+    
+    def conversation_validators(self, files, variant=''):
+        """Build ETag and Last-Modified values from conversation file stats, without reading them"""
+        stats = [(conversation_file.name, conversation_file.stat()) for conversation_file in files]
+        fingerprint = variant + '|' + ';'.join(f"{name}:{stat.st_mtime_ns}:{stat.st_size}" for name, stat in sorted(stats))
+        etag = f'W/"{hashlib.sha1(fingerprint.encode("utf-8")).hexdigest()[:16]}"'
+        last_modified = max((stat.st_mtime for _, stat in stats), default=None)
+        return etag, last_modified
+    
+    def is_not_modified(self, etag, last_modified):
+        """Check If-None-Match / If-Modified-Since against the current validators"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match:
+            return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
         
-        response_json = json.dumps(data)
-        self.wfile.write(response_json.encode('utf-8'))
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since and last_modified is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+            # HTTP dates only have one-second resolution
+            return int(last_modified) <= since
+        return False
+    
+    def send_not_modified(self, etag, last_modified):
+        """Tell the client its cached copy is still current"""
+        self.send_response(304)
+        self.send_validator_headers(etag, last_modified)
+        self.send_cors_headers()
+        self.end_headers()
+    
+    def send_validator_headers(self, etag, last_modified):
+        self.send_header('ETag', etag)
+        if last_modified is not None:
+            self.send_header('Last-Modified', email.utils.formatdate(last_modified, usegmt=True))
+        self.send_header('Cache-Control', 'no-cache')
+    
+    def send_cors_headers(self):
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', f'Content-Type, If-None-Match, If-Modified-Since, {REQUEST_TIMEOUT_HEADER}, {SESSION_HEADER}')
+        self.send_header('Access-Control-Expose-Headers', 'ETag, Last-Modified')
     
     def do_OPTIONS(self):
         """Handle preflight requests"""
         self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_cors_headers()
         self.end_headers()
 
-def open_browser():
+class ChatBotServer(socketserver.ThreadingTCPServer):
+    # Handle each request on its own thread so one slow chat doesn't block the rest
+    daemon_threads = True
+    # Let a restarted server rebind the port while old connections are in TIME_WAIT
+    allow_reuse_address = True
+    
+    def process_request(self, request, client_address):
+        """Count the connection as in flight from accept, before its headers are parsed"""
+        server_state.begin_request()
+        super().process_request(request, client_address)
+    
+    def shutdown_request(self, request):
+        """Close the connection and stop counting it as in flight"""
+        try:
+            super().shutdown_request(request)
+        finally:
+            server_state.end_request()
+
+def stop_workers():
+    """Drop queued upstream work; threads still running are abandoned, not joined"""
+    for executor in (upstream_executor, hedge_executor, grounding_executor):
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def open_browser(url):
     """Open browser after a short delay"""
+    import webbrowser
     time.sleep(1.5)  # Wait for server to start
-    webbrowser.open('http://localhost:8000')
+    webbrowser.open(url)
+
+def warm_up():
+    """Load the upstream HTTP client in the background, then report ready"""
+    requests.load()
+    server_state.ready = True
+    print("✅ Server is ready to accept chats")
+
+def parse_args(argv=None):
+    """Read server options from the command line, falling back to environment variables"""
+    parser = argparse.ArgumentParser(description="Run the AI Chatbot server")
+    parser.add_argument('--host', default=os.environ.get('CHATBOT_HOST', ''),
+                        help="Interface to bind (env CHATBOT_HOST, default all interfaces)")
+    parser.add_argument('--port', type=int, default=int(os.environ.get('CHATBOT_PORT', '8000')),
+                        help="Port to listen on (env CHATBOT_PORT, default 8000)")
+    parser.add_argument('--headless', action='store_true', default=os.environ.get('CHATBOT_HEADLESS', '') == '1',
+                        help="Don't open a browser (env CHATBOT_HEADLESS=1)")
+    parser.add_argument('--api-key', default=None,
+                        help="Gemini API key (env GEMINI_API_KEY)")
+    parser.add_argument('--drain-timeout', type=float, default=float(os.environ.get('CHATBOT_DRAIN_TIMEOUT', '30')),
+                        help="Seconds to let in-flight requests finish on shutdown (env CHATBOT_DRAIN_TIMEOUT, default 30)")
+    return parser.parse_args(argv)
 
 def main():
-    PORT = 8000
+    global GEMINI_API_KEY
+    args = parse_args()
+    if args.api_key:
+        GEMINI_API_KEY = args.api_key
+    
+    PORT = args.port
+    url = f"http://localhost:{PORT}"
     
     print("🤖 Starting Simple AI Chatbot Server...")
-    print(f"📡 Server will be available at: http://localhost:{PORT}")
-    print(f"🔗 Open http://localhost:{PORT} in your browser to use the chatbot")
+    print(f"📡 Server will be available at: {url}")
+    if args.headless:
+        print("🖥️ Running headless, health checks at /healthz and /readyz")
+    else:
+        print(f"🔗 Open {url} in your browser to use the chatbot")
     print("⚡ Press Ctrl+C to stop the server")
     print("-" * 50)
     
-    # Change to the script directory
-    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if GEMINI_API_KEY == API_KEY_PLACEHOLDER:
+        print("⚠️ No Gemini API key set. Use --api-key or the GEMINI_API_KEY environment variable.")
     
-    # Start browser in a separate thread
-    browser_thread = threading.Thread(target=open_browser)
-    browser_thread.daemon = True
-    browser_thread.start()
+    # Serve files from the script directory without changing the working directory
+    handler = functools.partial(ChatBotHandler, directory=STATIC_DIR)
     
-    with socketserver.TCPServer(("", PORT), ChatBotHandler) as httpd:
-        try:
-            print("✅ Server started successfully!")
+    try:
+        httpd = ChatBotServer((args.host, PORT), handler)
+    except OSError as e:
+        if e.errno == errno.EADDRINUSE or "10048" in str(e):
+            print(f"❌ Port {PORT} is already in use. Please close any other servers and try again.")
+        else:
+            print(f"❌ Server error: {e}")
+        return
+    
+    def request_shutdown(signum, frame):
+        if server_state.draining:
+            print("\n⚠️ Forced shutdown, dropping in-flight requests")
+            os._exit(1)
+        server_state.draining = True
+        print(f"\n🛑 Shutting down, waiting up to {args.drain_timeout:.0f}s for in-flight requests...")
+        # shutdown() blocks until serve_forever returns, so it can't run on this thread
+        threading.Thread(target=httpd.shutdown, daemon=True).start()
+    
+    signal.signal(signal.SIGTERM, request_shutdown)
+    signal.signal(signal.SIGINT, request_shutdown)
+    
+    threading.Thread(target=warm_up, daemon=True).start()
+    
+    if not args.headless:
+        # Start browser in a separate thread
+        browser_thread = threading.Thread(target=open_browser, args=(url,))
+        browser_thread.daemon = True
+        browser_thread.start()
+    
+    with httpd:
+        print("✅ Server started successfully!")
+        if not args.headless:
             print("🌐 Opening browser automatically...")
-            httpd.serve_forever()
-        except KeyboardInterrupt:
-            print("\n👋 Server stopped. Thanks for using AI Chatbot!")
-        except OSError as e:
-            if "10048" in str(e):
-                print(f"❌ Port {PORT} is already in use. Please close any other servers and try again.")
-            else:
-                print(f"❌ Server error: {e}")
+        httpd.serve_forever()
+    
+    # The listening socket is closed now; let requests already being handled finish
+    if server_state.wait_for_drain(args.drain_timeout):
+        stop_workers()
+        print("👋 Server stopped. Thanks for using AI Chatbot!")
+        return
+    
+    print(f"⚠️ Drain timeout reached, dropping {server_state.in_flight} in-flight request(s)")
+    # Abort blocked upstream calls and exit without waiting on the non-daemon pool threads
+    server_state.cancel_requests()
+    stop_workers()
+    sys.stdout.flush()
+    os._exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
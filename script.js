@@ -3,6 +3,13 @@ class ChatBot {
         // Server configuration for localhost:8000
         this.serverUrl = 'http://localhost:8000';
         
+        // Overall budget (seconds) the server has to answer a chat or search request
+        this.requestTimeout = 45;
+        
+        // Identifies this tab's chats in the server's token usage reports
+        this.sessionId = sessionStorage.getItem('chatbot-session-id') || `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+        sessionStorage.setItem('chatbot-session-id', this.sessionId);
+        
         // DOM elements
         this.chatMessages = document.getElementById('chatMessages');
         this.messageInput = document.getElementById('messageInput');
@@ -33,6 +40,21 @@ class ChatBot {
         // File storage
         this.selectedFiles = [];
         
+        // Conversation responses keyed by request, revalidated with their ETag
+        this.conversationCache = new Map();
+        
+        // Message model; only the window [windowStart, windowEnd) is rendered in the DOM
+        this.messages = [];
+        this.windowStart = 0;
+        this.windowEnd = 0;
+        this.windowBusy = false;
+        this.windowUpdateScheduled = false;
+        this.historySource = null;
+        this.historyGeneration = 0;
+        this.historyPageSize = 100;
+        this.renderBatchSize = 40;
+        this.maxRenderedMessages = 150;
+        
         // Voice recognition
         this.recognition = null;
         this.isRecording = false;
@@ -42,7 +64,8 @@ class ChatBot {
             theme: 'auto',
             fontSize: 15,
             temperature: 0.7,
-            voiceEnabled: false
+            voiceEnabled: false,
+            groundingEnabled: false
         };
         
         // Initialize
@@ -87,6 +110,9 @@ class ChatBot {
         if (document.getElementById('voiceEnabled')) {
             document.getElementById('voiceEnabled').checked = this.settings.voiceEnabled;
         }
+        if (document.getElementById('groundingEnabled')) {
+            document.getElementById('groundingEnabled').checked = this.settings.groundingEnabled;
+        }
         
         // Apply font size
         document.documentElement.style.setProperty('--message-font-size', this.settings.fontSize + 'px');
@@ -157,6 +183,13 @@ class ChatBot {
             });
         }
         
+        if (document.getElementById('groundingEnabled')) {
+            document.getElementById('groundingEnabled').addEventListener('change', (e) => {
+                this.settings.groundingEnabled = e.target.checked;
+                this.saveSettings();
+            });
+        }
+        
         if (document.getElementById('exportChatBtn')) {
             document.getElementById('exportChatBtn').addEventListener('click', () => this.exportChat());
         }
@@ -201,6 +234,7 @@ class ChatBot {
         // Scroll detection for scroll-to-bottom button
         this.chatMessages.addEventListener('scroll', () => {
             this.updateScrollToBottomButton();
+            this.scheduleWindowUpdate();
         });
     }
 
@@ -667,10 +701,13 @@ class ChatBot {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'X-Request-Timeout': String(this.requestTimeout),
+                'X-Session-Id': this.sessionId
             },
             body: JSON.stringify({ 
                 message: message,
-                temperature: this.settings.temperature 
+                temperature: this.settings.temperature,
+                grounding: this.settings.groundingEnabled
             })
         });
 
@@ -685,6 +722,15 @@ class ChatBot {
             throw new Error('Invalid response format from server');
         }
 
+        // Grounded answers list the search results the server used
+        if (data.sources && data.sources.length > 0) {
+            let sourcesText = '\n\n**Sources:**\n';
+            data.sources.forEach((source, index) => {
+                sourcesText += `[${index + 1}] ${source.title} - ${source.url}\n`;
+            });
+            return data.response + sourcesText;
+        }
+
         return data.response;
     }
 
@@ -694,6 +740,7 @@ class ChatBot {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'X-Request-Timeout': String(this.requestTimeout)
                 },
                 body: JSON.stringify({ query: query })
             });
@@ -733,6 +780,7 @@ class ChatBot {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'X-Request-Timeout': String(this.requestTimeout)
                 },
                 body: JSON.stringify({ query: query })
             });
@@ -783,8 +831,27 @@ class ChatBot {
     }
 
     addMessage(text, sender) {
+        const index = this.messages.push({ text: text, sender: sender, time: this.getCurrentTime() }) - 1;
+        
+        if (this.windowEnd < index) {
+            // The user scrolled back through history, so jump the window to the latest messages
+            this.renderWindow(Math.max(0, index + 1 - this.renderBatchSize), index + 1);
+        } else {
+            this.chatMessages.appendChild(this.createMessageElement(index));
+            this.windowEnd = index + 1;
+            this.trimWindow('top');
+        }
+        
+        this.scrollToBottom();
+    }
+
+    createMessageElement(index) {
+        const message = this.messages[index];
+        const sender = message.sender;
+        
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${sender}-message`;
+        messageDiv.dataset.index = index;
         
         const avatarDiv = document.createElement('div');
         avatarDiv.className = 'message-avatar';
@@ -799,13 +866,15 @@ class ChatBot {
         const textDiv = document.createElement('div');
         textDiv.className = 'message-text';
         
-        // Handle text formatting and convert markdown-like syntax
-        const formattedText = this.formatMessage(text);
-        textDiv.innerHTML = formattedText;
+        // Format markdown once per message and reuse it when the window re-renders it
+        if (message.html === undefined) {
+            message.html = this.formatMessage(message.text);
+        }
+        textDiv.innerHTML = message.html;
         
         const timeDiv = document.createElement('div');
         timeDiv.className = 'message-time';
-        timeDiv.textContent = this.getCurrentTime();
+        timeDiv.textContent = message.time;
         
         // Add message actions
         const actionsDiv = document.createElement('div');
@@ -844,8 +913,6 @@ class ChatBot {
         messageDiv.appendChild(avatarDiv);
         messageDiv.appendChild(contentDiv);
         
-        this.chatMessages.appendChild(messageDiv);
-        
         // Highlight code blocks
         if (typeof hljs !== 'undefined') {
             messageDiv.querySelectorAll('pre code').forEach(block => {
@@ -853,7 +920,172 @@ class ChatBot {
             });
         }
         
-        this.scrollToBottom();
+        return messageDiv;
+    }
+
+    renderRange(start, end) {
+        // Build rendered nodes off-DOM so inserting a batch costs a single layout
+        const fragment = document.createDocumentFragment();
+        for (let i = start; i < end; i++) {
+            const message = this.messages[i];
+            if (message && !message.deleted) {
+                const node = this.createMessageElement(i);
+                node.classList.add('history-message');
+                fragment.appendChild(node);
+            }
+        }
+        return fragment;
+    }
+
+    renderedMessages() {
+        return Array.from(this.chatMessages.querySelectorAll('.message[data-index]'));
+    }
+
+    renderWindow(start, end) {
+        this.renderedMessages().forEach(node => node.remove());
+        this.chatMessages.appendChild(this.renderRange(start, end));
+        this.windowStart = start;
+        this.windowEnd = end;
+        this.updateWelcomeVisibility();
+    }
+
+    scheduleWindowUpdate() {
+        if (this.windowUpdateScheduled) return;
+        this.windowUpdateScheduled = true;
+        requestAnimationFrame(() => {
+            this.windowUpdateScheduled = false;
+            this.updateWindow().catch(error => {
+                this.showToast('Error loading messages: ' + error.message, 'error');
+            });
+        });
+    }
+
+    async updateWindow() {
+        if (this.windowBusy) return;
+        
+        const el = this.chatMessages;
+        const nearTop = el.scrollTop < el.clientHeight;
+        const nearBottom = el.scrollTop + el.clientHeight > el.scrollHeight - el.clientHeight;
+        
+        this.windowBusy = true;
+        try {
+            if (nearTop && this.windowStart > 0) {
+                const start = Math.max(0, this.windowStart - this.renderBatchSize);
+                if (await this.ensureMessagesLoaded(start, this.windowStart)) {
+                    this.prependWindow(start);
+                }
+            } else if (nearBottom && this.windowEnd < this.messages.length) {
+                const end = Math.min(this.messages.length, this.windowEnd + this.renderBatchSize);
+                if (await this.ensureMessagesLoaded(this.windowEnd, end)) {
+                    this.appendWindow(end);
+                }
+            }
+        } finally {
+            this.windowBusy = false;
+        }
+    }
+
+    prependWindow(start) {
+        const el = this.chatMessages;
+        const firstRendered = this.renderedMessages()[0] || null;
+        const previousHeight = el.scrollHeight;
+        
+        el.insertBefore(this.renderRange(start, this.windowStart), firstRendered);
+        this.windowStart = start;
+        this.updateWelcomeVisibility();
+        
+        // Keep the messages the user is reading in place
+        this.adjustScrollTop(el.scrollHeight - previousHeight);
+        this.trimWindow('bottom');
+    }
+
+    appendWindow(end) {
+        this.chatMessages.appendChild(this.renderRange(this.windowEnd, end));
+        this.windowEnd = end;
+        this.trimWindow('top');
+    }
+
+    trimWindow(side) {
+        if (this.windowEnd - this.windowStart <= this.maxRenderedMessages) return;
+        
+        const el = this.chatMessages;
+        const previousHeight = el.scrollHeight;
+        
+        if (side === 'top') {
+            this.windowStart = this.windowEnd - this.maxRenderedMessages;
+            this.renderedMessages()
+                .filter(node => Number(node.dataset.index) < this.windowStart)
+                .forEach(node => node.remove());
+            this.updateWelcomeVisibility();
+            this.adjustScrollTop(el.scrollHeight - previousHeight);
+        } else {
+            this.windowEnd = this.windowStart + this.maxRenderedMessages;
+            this.renderedMessages()
+                .filter(node => Number(node.dataset.index) >= this.windowEnd)
+                .forEach(node => node.remove());
+        }
+    }
+
+    adjustScrollTop(delta) {
+        if (!delta) return;
+        // Smooth scrolling would animate the correction and make the content jump
+        this.chatMessages.style.scrollBehavior = 'auto';
+        this.chatMessages.scrollTop += delta;
+        this.chatMessages.style.scrollBehavior = '';
+    }
+
+    updateWelcomeVisibility() {
+        const welcomeMessage = this.chatMessages.querySelector('.message:not([data-index])');
+        if (welcomeMessage) {
+            welcomeMessage.style.display = this.windowStart > 0 ? 'none' : '';
+        }
+    }
+
+    async ensureMessagesLoaded(start, end) {
+        // Returns false if another conversation was loaded while this page was being fetched
+        if (!this.historySource) return true;
+        
+        let missingEnd = end;
+        while (missingEnd > start && this.messages[missingEnd - 1]) {
+            missingEnd--;
+        }
+        if (missingEnd === start) return true;
+        
+        let missingStart = start;
+        while (this.messages[missingStart]) {
+            missingStart++;
+        }
+        
+        const generation = this.historyGeneration;
+        const result = await this.fetchConversationResource('/load-conversation', {
+            filename: this.historySource,
+            before: missingEnd,
+            limit: Math.max(missingEnd - missingStart, this.historyPageSize)
+        }, null);
+        
+        if (generation !== this.historyGeneration) return false;
+        if (!result.success) {
+            throw new Error(result.error);
+        }
+        this.storeHistoryPage(result);
+        return true;
+    }
+
+    storeHistoryPage(result) {
+        const offset = result.offset || 0;
+        result.conversation.messages.forEach((msg, i) => {
+            if (!this.messages[offset + i]) {
+                this.messages[offset + i] = { text: msg.text, sender: msg.sender, time: msg.time || '' };
+            }
+        });
+    }
+
+    resetMessages() {
+        this.messages = [];
+        this.windowStart = 0;
+        this.windowEnd = 0;
+        this.historySource = null;
+        this.historyGeneration++;
     }
 
     copyMessage(button) {
@@ -865,23 +1097,23 @@ class ChatBot {
 
     regenerateMessage(button) {
         // Get the previous user message and regenerate response
-        const messages = Array.from(this.chatMessages.querySelectorAll('.message'));
-        const currentIndex = messages.indexOf(button.closest('.message'));
-        
-        if (currentIndex > 0) {
-            const prevMessage = messages[currentIndex - 1];
-            if (prevMessage.classList.contains('user-message')) {
-                const userText = prevMessage.querySelector('.message-text').innerText;
-                this.getServerResponse(userText).then(response => {
-                    button.closest('.message-text').innerHTML = this.formatMessage(response);
-                    // Re-highlight code
-                    if (typeof hljs !== 'undefined') {
-                        button.closest('.message').querySelectorAll('pre code').forEach(block => {
-                            hljs.highlightElement(block);
-                        });
-                    }
-                });
-            }
+        const messageDiv = button.closest('.message');
+        const index = Number(messageDiv.dataset.index);
+        const prevMessage = this.messages[index - 1];
+        
+        if (prevMessage && prevMessage.sender === 'user') {
+            this.getServerResponse(prevMessage.text).then(response => {
+                const message = this.messages[index];
+                message.text = response;
+                message.html = this.formatMessage(response);
+                messageDiv.querySelector('.message-text').innerHTML = message.html;
+                // Re-highlight code
+                if (typeof hljs !== 'undefined') {
+                    messageDiv.querySelectorAll('pre code').forEach(block => {
+                        hljs.highlightElement(block);
+                    });
+                }
+            });
         }
     }
 
@@ -896,13 +1128,18 @@ class ChatBot {
         
         const newText = prompt('Edit your message:', currentText);
         if (newText && newText !== currentText) {
-            messageTextDiv.innerHTML = this.formatMessage(newText);
+            const message = this.messages[Number(button.closest('.message').dataset.index)];
+            message.text = newText;
+            message.html = this.formatMessage(newText);
+            messageTextDiv.innerHTML = message.html;
         }
     }
 
     deleteMessage(button) {
         if (confirm('Are you sure you want to delete this message?')) {
-            button.closest('.message').remove();
+            const messageDiv = button.closest('.message');
+            this.messages[Number(messageDiv.dataset.index)].deleted = true;
+            messageDiv.remove();
         }
     }
 
@@ -936,6 +1173,11 @@ class ChatBot {
     }
 
     scrollToBottom() {
+        // Bring the latest messages back into the window before scrolling to them
+        if (this.windowEnd < this.messages.length) {
+            this.renderWindow(Math.max(0, this.messages.length - this.renderBatchSize), this.messages.length);
+        }
+        
         setTimeout(() => {
             this.chatMessages.scrollTop = this.chatMessages.scrollHeight;
         }, 100);
@@ -943,8 +1185,9 @@ class ChatBot {
 
     clearChatHistory() {
         if (confirm('Are you sure you want to clear the chat history?')) {
-            const welcomeMessage = this.chatMessages.querySelector('.message.bot-message');
+            const welcomeMessage = this.chatMessages.querySelector('.message:not([data-index])');
             this.chatMessages.innerHTML = '';
+            this.resetMessages();
             
             if (welcomeMessage) {
                 this.chatMessages.appendChild(welcomeMessage.cloneNode(true));
@@ -953,6 +1196,7 @@ class ChatBot {
                     welcomeTimeElement.textContent = this.getCurrentTime();
                 }
             }
+            this.updateWelcomeVisibility();
             
             // Clear file previews
             const filePreviewContainer = document.getElementById('file-preview-container');
@@ -979,18 +1223,28 @@ class ChatBot {
         }
     }
 
-    exportChat() {
-        const messages = Array.from(this.chatMessages.querySelectorAll('.message'));
+    async exportChat() {
+        // Export from the message model, fetching any history pages that were never scrolled into view
+        try {
+            await this.ensureMessagesLoaded(0, this.messages.length);
+        } catch (error) {
+            this.showToast('Error loading messages: ' + error.message, 'error');
+            return;
+        }
         
         let content = `# Chat Export - ${new Date().toLocaleString()}\n\n`;
         
-        messages.forEach(message => {
-            const isBot = message.classList.contains('bot-message');
-            const sender = isBot ? 'Assistant' : 'User';
-            const text = message.querySelector('.message-text').innerText;
-            const time = message.querySelector('.message-time').textContent;
-            
-            content += `## ${sender} (${time})\n\n${text}\n\n---\n\n`;
+        const welcomeMessage = this.chatMessages.querySelector('.message:not([data-index])');
+        if (welcomeMessage) {
+            const text = welcomeMessage.querySelector('.message-text').innerText;
+            const time = welcomeMessage.querySelector('.message-time').textContent;
+            content += `## Assistant (${time})\n\n${text}\n\n---\n\n`;
+        }
+        
+        this.messages.forEach(message => {
+            if (!message || message.deleted) return;
+            const sender = message.sender === 'bot' ? 'Assistant' : 'User';
+            content += `## ${sender} (${message.time})\n\n${message.text}\n\n---\n\n`;
         });
         
         // Create download link
@@ -1009,8 +1263,7 @@ class ChatBot {
 
     // Conversation Management Methods
     async saveCurrentConversation() {
-        const messages = Array.from(this.chatMessages.querySelectorAll('.message'));
-        if (messages.length <= 1) { // Only welcome message
+        if (!this.messages.some(message => message && !message.deleted)) { // Only welcome message
             this.showToast('No conversation to save', 'warning');
             return;
         }
@@ -1020,22 +1273,21 @@ class ChatBot {
         
         if (!conversationName) return;
 
-        const conversationData = [];
-        messages.forEach(message => {
-            if (!message.querySelector('#welcomeTime')) { // Skip welcome message
-                const isBot = message.classList.contains('bot-message');
-                const text = message.querySelector('.message-text').innerText;
-                const time = message.querySelector('.message-time').textContent;
-                
-                conversationData.push({
-                    sender: isBot ? 'bot' : 'user',
-                    text: text,
-                    time: time
-                });
-            }
-        });
-
         try {
+            // Saving needs every message, including history pages never scrolled into view
+            await this.ensureMessagesLoaded(0, this.messages.length);
+            
+            const conversationData = [];
+            this.messages.forEach(message => {
+                if (message && !message.deleted) {
+                    conversationData.push({
+                        sender: message.sender,
+                        text: message.text,
+                        time: message.time
+                    });
+                }
+            });
+
             const response = await fetch(`${this.serverUrl}/save-conversation`, {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
@@ -1059,13 +1311,7 @@ class ChatBot {
 
     async loadConversationsList() {
         try {
-            const response = await fetch(`${this.serverUrl}/list-conversations`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({})
-            });
-
-            const result = await response.json();
+            const result = await this.fetchConversationResource('/list-conversations', {}, 'list');
             if (result.success) {
                 this.renderConversationsList(result.conversations);
             } else {
@@ -1076,6 +1322,32 @@ class ChatBot {
         }
     }
 
+    async fetchConversationResource(path, body, cacheKey) {
+        // Send the cached ETag so unchanged conversations come back as an empty 304
+        const cached = cacheKey ? this.conversationCache.get(cacheKey) : null;
+        const headers = { 'Content-Type': 'application/json' };
+        if (cached) {
+            headers['If-None-Match'] = cached.etag;
+        }
+
+        const response = await fetch(`${this.serverUrl}${path}`, {
+            method: 'POST',
+            headers: headers,
+            body: JSON.stringify(body)
+        });
+
+        if (response.status === 304 && cached) {
+            return cached.result;
+        }
+
+        const result = await response.json();
+        const etag = response.headers.get('ETag');
+        if (cacheKey && result.success && etag) {
+            this.conversationCache.set(cacheKey, { etag: etag, result: result });
+        }
+        return result;
+    }
+
     renderConversationsList(conversations) {
         if (conversations.length === 0) {
             this.conversationList.innerHTML = '<p class="no-conversations">No saved conversations yet</p>';
@@ -1100,20 +1372,21 @@ class ChatBot {
 
     async loadConversation(filename) {
         try {
-            const response = await fetch(`${this.serverUrl}/load-conversation`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ filename: filename })
-            });
-
-            const result = await response.json();
+            // Fetch only the latest page; older pages load as the user scrolls up
+            const result = await this.fetchConversationResource('/load-conversation', {
+                filename: filename,
+                limit: this.historyPageSize
+            }, `load:${filename}`);
             if (result.success) {
                 this.clearChatHistoryImmediate();
                 
                 // Load messages
-                result.conversation.messages.forEach(msg => {
-                    this.addMessage(msg.text, msg.sender);
-                });
+                const total = result.total || result.conversation.messages.length;
+                this.historySource = filename;
+                this.messages = new Array(total);
+                this.storeHistoryPage(result);
+                this.renderWindow(Math.max(0, total - this.renderBatchSize), total);
+                this.scrollToBottom();
                 
                 this.conversationsPanel.classList.remove('active');
                 this.showToast(`Loaded conversation: ${result.conversation.name}`, 'success');
@@ -1149,8 +1422,9 @@ class ChatBot {
 
     clearChatHistoryImmediate() {
         // Clear without confirmation (used for loading conversations)
-        const welcomeMessage = this.chatMessages.querySelector('.message.bot-message');
+        const welcomeMessage = this.chatMessages.querySelector('.message:not([data-index])');
         this.chatMessages.innerHTML = '';
+        this.resetMessages();
         
         if (welcomeMessage) {
             this.chatMessages.appendChild(welcomeMessage.cloneNode(true));
@@ -1159,6 +1433,7 @@ class ChatBot {
                 welcomeTimeElement.textContent = this.getCurrentTime();
             }
         }
+        this.updateWelcomeVisibility();
     }
 
     showToast(message, type = 'info') {